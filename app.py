@@ -1,162 +1,510 @@
 import os
-from flask import Flask, render_template, request, redirect, url_for, send_file, jsonify, session
-import pdfplumber
-import docx
-from werkzeug.utils import secure_filename
+from flask import Flask, render_template, request, redirect, url_for, send_from_directory, jsonify, session
+from flask_session import Session
+import redis
 import google.generativeai as genai
-from fpdf import FPDF
 from dotenv import load_dotenv
+from llm_cache import cached_generate, peek, remember, cache_stats
+import json
+import logging
+import io
+import hashlib
+import html
+import uuid
+import math
 import time
+import itertools
+from datetime import timedelta
+from typing import TypedDict
+from concurrent.futures import ThreadPoolExecutor
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Debug output is off unless LOG_LEVEL=DEBUG; %-style arguments are only formatted when emitted
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'))
+log = logging.getLogger(__name__)
+
 # Configure Google API
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 if not GOOGLE_API_KEY:
     raise ValueError("GOOGLE_API_KEY not found in environment variables")
 
-genai.configure(api_key=GOOGLE_API_KEY)
+# gRPC multiplexes every Gemini call over one long-lived HTTP/2 connection;
+# gunicorn.conf.py makes it cooperate with the gevent workers
+genai.configure(api_key=GOOGLE_API_KEY, transport="grpc")
 model = genai.GenerativeModel("gemini-2.0-flash")
 
+# Asks Gemini for a bare JSON document instead of free text
+JSON_RESPONSE_CONFIG = genai.GenerationConfig(response_mime_type="application/json")
+
+# Shape of each generated question; Gemini returns a JSON list of these
+class MCQ(TypedDict):
+    question: str
+    options: list[str]
+    correct_index: int
+
+MCQ_RESPONSE_CONFIG = genai.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=list[MCQ]
+)
+
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads/'
 app.config['RESULTS_FOLDER'] = 'results/'
-app.config['ALLOWED_EXTENSIONS'] = {'pdf', 'txt', 'doc', 'docx'}
+app.config['TEXT_CACHE_FOLDER'] = 'cache/text/'
+ALLOWED_EXTENSIONS = frozenset({'pdf', 'txt', 'doc', 'docx'})
+app.config['ALLOWED_EXTENSIONS'] = ALLOWED_EXTENSIONS
+app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # Reject larger uploads with 413
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'your_secret_key')  # Use environment variable with fallback
+# Behind nginx/apache, let the proxy send downloads itself (X-Sendfile) instead of streaming them through Python.
+# Only enable this when such a proxy is configured; otherwise downloads arrive empty.
+app.use_x_sendfile = os.getenv('USE_X_SENDFILE') == '1'
+
+# Keep quiz data server-side so the cookie only carries a session id.
+# Redis lets all Gunicorn workers share sessions; without it, fall back to local files.
+REDIS_URL = os.getenv('REDIS_URL')
+if REDIS_URL:
+    app.config['SESSION_TYPE'] = 'redis'
+    app.config['SESSION_REDIS'] = redis.from_url(REDIS_URL)
+else:
+    app.config['SESSION_TYPE'] = 'filesystem'
+    app.config['SESSION_FILE_DIR'] = 'flask_session/'
+# Quiz data is only needed for the length of a sitting; expire stored sessions after that
+app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=2)
+Session(app)
 
 # Ensure folders exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['RESULTS_FOLDER'], exist_ok=True)
+os.makedirs(app.config['TEXT_CACHE_FOLDER'], exist_ok=True)
+
+# Upper bound on document text sent to Gemini (~15k tokens at ~4 characters per token);
+# cost and latency scale with input tokens
+MAX_INPUT_CHARS = 60_000
+
+# Extraction stops once it has this much text; longer documents are sampled down to
+# MAX_INPUT_CHARS in sections of SAMPLE_CHUNK_CHARS (~500 tokens) spread across the text
+MAX_EXTRACT_CHARS = 4 * MAX_INPUT_CHARS
+SAMPLE_CHUNK_CHARS = 2_000
+SAMPLE_SEPARATOR = '\n---\n'
+
+# Runs work that should not hold up a response, such as writing PDFs
+background_executor = ThreadPoolExecutor(max_workers=4)
+
+# Concurrent Gemini requests when explanations are fetched one question at a time
+EXPLANATION_WORKERS = 8
+
+# A background PDF build that hasn't produced its file or failure marker by then is treated as lost
+FILE_TASK_TIMEOUT_SECONDS = 5 * 60
+
+def failure_marker_path(filename):
+    return os.path.join(app.config['RESULTS_FOLDER'], f".{filename}.failed")
+
+def submit_file_task(filename, fn, *args):
+    def file_task_done(future):
+        exc = future.exception()
+        if exc is None:
+            return
+        log.error("Error writing %s", filename, exc_info=exc)
+        # Any worker may be asked about this file, so record the failure on disk
+        try:
+            open(failure_marker_path(filename), 'w').close()
+        except OSError as e:
+            log.warning("Could not record failure for %s: %s", filename, e)
+
+    future = background_executor.submit(fn, *args)
+    future.add_done_callback(file_task_done)
+    return future
+
+def file_task_state(filename, started_at):
+    # 'ready', 'pending' or 'failed', judged only from the filesystem and the
+    # start time kept in the session, so every worker gives the same answer
+    if os.path.exists(os.path.join(app.config['RESULTS_FOLDER'], filename)):
+        return 'ready'
+    if os.path.exists(failure_marker_path(filename)) or time.time() - started_at > FILE_TASK_TIMEOUT_SECONDS:
+        return 'failed'
+    return 'pending'
+
+# Session keys holding each background file's name and start time
+NOTES_FILE_KEYS = ('current_notes_file', 'notes_started_at')
+RESULTS_FILE_KEYS = ('results_file', 'results_started_at')
+
+def session_file_state(keys):
+    # (filename, state) for this session's file, or (None, None) if it was never started
+    file_key, started_key = keys
+    filename = session.get(file_key)
+    if not filename:
+        return None, None
+    return filename, file_task_state(filename, session.get(started_key, 0))
+
+# Unicode TrueType font for generated PDFs; the core PDF fonts only cover Latin-1,
+# and Gemini output often has curly quotes, dashes and bullets
+PDF_FONT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts')
+PDF_FONT = "DejaVu"
+
+def new_pdf():
+    from fpdf import FPDF
+    pdf = FPDF()
+    pdf.add_font(PDF_FONT, "", os.path.join(PDF_FONT_DIR, "DejaVuSans.ttf"))
+    pdf.add_font(PDF_FONT, "B", os.path.join(PDF_FONT_DIR, "DejaVuSans-Bold.ttf"))
+    return pdf
+
+def output_pdf(pdf, filename):
+    # Write under a temporary dot-name and rename, so any worker that sees the
+    # file in RESULTS_FOLDER sees it complete (/download rejects dot-names)
+    path = os.path.join(app.config['RESULTS_FOLDER'], filename)
+    temp_path = os.path.join(app.config['RESULTS_FOLDER'], f".{filename}.part")
+    pdf.output(temp_path)
+    os.replace(temp_path, path)
+    return path
+
+# Generated PDFs (and failure markers) older than this are removed. A session that still
+# refers to a removed PDF sees it as failed and builds it again from the quiz data it holds.
+RESULTS_MAX_AGE_SECONDS = 2 * 60 * 60
+RESULTS_CLEANUP_INTERVAL_SECONDS = 10 * 60
+last_results_cleanup = 0.0
+
+def remove_stale_results():
+    cutoff = time.time() - RESULTS_MAX_AGE_SECONDS
+    for entry in os.scandir(app.config['RESULTS_FOLDER']):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError as e:
+            log.warning("Could not remove old result file %s: %s", entry.path, e)
+
+def schedule_results_cleanup():
+    # At most one scan per worker per interval
+    global last_results_cleanup
+    now = time.time()
+    if now - last_results_cleanup >= RESULTS_CLEANUP_INTERVAL_SECONDS:
+        last_results_cleanup = now
+        background_executor.submit(remove_stale_results)
+
+# Number of leading pages checked for a text layer before parsing the rest
+SCANNED_PDF_PROBE_PAGES = 3
+
+def file_extension(filename):
+    # Lower-cased text after the last '.', or '' if there is none
+    i = filename.rfind('.')
+    return filename[i + 1:].lower() if i != -1 else ''
 
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
+    return file_extension(filename) in ALLOWED_EXTENSIONS
+
+def extract_pdf_page_texts(file_path):
+    import fitz  # PyMuPDF
+
+    with fitz.open(file_path) as pdf:
+        page_count = pdf.page_count
+
+        # If the first pages carry images but no text layer, the document is a scan
+        # and parsing the remaining pages would only burn time finding nothing
+        probe = min(SCANNED_PDF_PROBE_PAGES, page_count)
+        page_texts = [pdf[i].get_text("text") for i in range(probe)]
+        if probe and not any(t.strip() for t in page_texts) and all(pdf[i].get_images() for i in range(probe)):
+            log.debug("No text layer in the first %s pages of %s, treating it as scanned", probe, file_path)
+            return []
+
+        # Pages take a few milliseconds each and extraction stops at MAX_EXTRACT_CHARS,
+        # so parsing in-process is faster than starting worker processes
+        total = sum(len(t) for t in page_texts)
+
+        # For documents longer than the budget, read every step-th page (estimated from
+        # the probed pages) so the extracted text spans the whole document
+        step = 1
+        remaining = page_count - probe
+        if 0 < total < MAX_EXTRACT_CHARS and remaining:
+            budget_pages = (MAX_EXTRACT_CHARS - total) * probe / total
+            step = max(1, math.ceil(remaining / budget_pages))
+            if step > 1:
+                log.debug("Reading every %s pages of %s (%s pages)", step, file_path, page_count)
+
+        for i in range(probe, page_count, step):
+            if total >= MAX_EXTRACT_CHARS:
+                break
+            page_texts.append(pdf[i].get_text("text"))
+            total += len(page_texts[-1])
+        return page_texts
 
 def extract_text_from_file(file_path):
-    ext = file_path.rsplit('.', 1)[1].lower()
+    ext = file_extension(file_path)
     try:
-        print(f"Attempting to extract text from {file_path} with extension {ext}")  # Debug log
+        log.debug("Attempting to extract text from %s with extension %s", file_path, ext)
         if ext == 'pdf':
-            with pdfplumber.open(file_path) as pdf:
-                text = ''
-                for page in pdf.pages:
-                    page_text = page.extract_text()
-                    if page_text:
-                        text += page_text + '\n'
-                print(f"Successfully extracted {len(text)} characters from PDF")  # Debug log
-                return text
+            # Skip pages with no text layer (e.g. scanned images)
+            parts = [page_text for page_text in extract_pdf_page_texts(file_path) if page_text.strip()]
+            text = '\n'.join(parts)
+            log.debug("Successfully extracted %s characters from PDF", len(text))
+            return text
         elif ext in ['doc', 'docx']:  # Handle both .doc and .docx
             try:
-                # Ensure the file exists and is readable
-                if not os.path.exists(file_path):
-                    print(f"Word file not found at path: {file_path}")  # Debug log
-                    return None
-                
-                # Try to open the document
+                # The upload was just saved; if docx can't open it, the handler below reports why
+                import docx
                 doc = docx.Document(file_path)
-                text = ''
-                
-                # Extract text from paragraphs
-                for para in doc.paragraphs:
-                    if para.text.strip():  # Only add non-empty paragraphs
-                        text += para.text + '\n'
+                parts = []
+                total = 0
                 
-                # Extract text from tables if present
-                for table in doc.tables:
-                    for row in table.rows:
-                        for cell in row.cells:
-                            if cell.text.strip():
-                                text += cell.text + '\n'
+                # Extract text from paragraphs, then from tables if present
+                paragraphs = (para.text for para in doc.paragraphs)
+                cells = (cell.text for table in doc.tables for row in table.rows for cell in row.cells)
+                for part in itertools.chain(paragraphs, cells):
+                    if not part.strip():  # Only add non-empty paragraphs and cells
+                        continue
+                    parts.append(part)
+                    total += len(part)
+                    if total >= MAX_EXTRACT_CHARS:
+                        break
+                text = '\n'.join(parts)
                 
                 if not text.strip():
-                    print("No text content found in Word file")  # Debug log
+                    log.warning("No text content found in Word file")
                     return None
                     
-                print(f"Successfully extracted {len(text)} characters from Word file")  # Debug log
+                log.debug("Successfully extracted %s characters from Word file", len(text))
                 return text
             except Exception as doc_error:
-                print(f"Error processing Word file: {str(doc_error)}")  # Debug log
+                log.error("Error processing Word file: %s", doc_error)
                 return None
         elif ext == 'txt':
             with open(file_path, 'r', encoding='utf-8') as file:
-                text = file.read()
-                print(f"Successfully extracted {len(text)} characters from TXT")  # Debug log
+                text = file.read(MAX_EXTRACT_CHARS)
+                log.debug("Successfully extracted %s characters from TXT", len(text))
                 return text
     except Exception as e:
-        print(f"Error extracting text from {file_path}: {str(e)}")  # Debug log
+        log.error("Error extracting text from %s: %s", file_path, e)
         return None
 
-def generate_mcqs(input_data, num_questions, difficulty="easy", is_file=False):
-    difficulty_prompts = {
-        "easy": "Generate simple, straightforward questions suitable for beginners. Focus on basic concepts and definitions.",
-        "intermediate": "Generate moderately challenging questions that test understanding and application of concepts.",
-        "hard": "Generate complex questions that test deep understanding, analysis, and synthesis of concepts."
+def parse_mcq(item):
+    # Returns None for items that don't describe a usable 4-option question
+    if not isinstance(item, dict):
+        return None
+    question = item.get('question')
+    options = item.get('options')
+    index = item.get('correct_index')
+    if (not isinstance(question, str) or not isinstance(options, list) or len(options) != 4
+            or not isinstance(index, int) or not 0 <= index < 4):
+        return None
+    options = [str(option).strip() for option in options]
+    return {
+        'question': question.strip(),
+        'options': options,
+        'correct_answer': options[index]
     }
+
+def extract_text_cached(file_path, digest):
+    # Identical uploads (same SHA-256) reuse the text extracted the first time
+    cache_path = os.path.join(app.config['TEXT_CACHE_FOLDER'], f"{digest}.txt")
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r', encoding='utf-8') as file:
+            log.debug("Using cached text for %s", file_path)
+            return file.read()
+
+    text = extract_text_from_file(file_path)
+    if text:
+        # Write then rename, so a concurrent identical upload never reads a partial entry
+        temp_path = f"{cache_path}.{uuid.uuid4().hex}.part"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                file.write(text)
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            log.warning("Could not cache extracted text for %s: %s", file_path, e)
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+    return text
+
+DIFFICULTY_PROMPTS = {
+    "easy": "Generate simple, straightforward questions suitable for beginners. Focus on basic concepts and definitions.",
+    "intermediate": "Generate moderately challenging questions that test understanding and application of concepts.",
+    "hard": "Generate complex questions that test deep understanding, analysis, and synthesis of concepts."
+}
+
+FILE_MCQ_PROMPT = """
+Generate {num_questions} multiple-choice questions from the following text content:
+{content}
+
+{difficulty_prompt}
+
+Additional instructions for file-based questions:
+1. Use ONLY the information from the provided text content
+2. Focus on key concepts and important details from the text
+3. Include questions about specific facts, figures, or data mentioned in the text
+4. Create questions that test comprehension of the main ideas and supporting details
+5. Ensure questions are directly related to the content in the file
+6. Include at least one question about any tables, lists, or structured data if present
+7. Cover a broad range of topics from the text
+8. Ensure questions are well-distributed across different sections of the content
+
+Ensure each question has exactly 4 options and one correct answer.
+Do not prefix the options with letters. Give the correct answer as correct_index,
+the 0-based position of the correct option in the options list.
+"""
+
+TOPIC_MCQ_PROMPT = """
+Generate {num_questions} multiple-choice questions from the following topic:
+{content}
+
+{difficulty_prompt}
+
+Additional instructions for topic-based questions:
+1. Create questions that cover the main aspects of the topic
+2. Include both theoretical and practical questions
+3. Ensure questions are relevant to the given topic
+4. Create a good mix of definition, concept, and application questions
+5. Cover fundamental concepts and advanced aspects of the topic
+6. Include questions about key terminology and important principles
+7. Ensure questions test both understanding and application
+8. Create questions that help build a comprehensive understanding of the topic
+
+Ensure each question has exactly 4 options and one correct answer.
+Do not prefix the options with letters. Give the correct answer as correct_index,
+the 0-based position of the correct option in the options list.
+"""
+
+EXPLANATION_PROMPT = """
+Explain why '{correct_answer}' is the correct answer to:
+'{question}'
+
+Provide a clear, concise explanation in 2-3 sentences.
+"""
+
+NOTES_PROMPT = """
+Create comprehensive study notes based on the following quiz content:
+
+Quiz Questions and Answers:
+{questions_text}
+
+Create detailed study notes that:
+1. Start with a clear introduction explaining the main topic
+2. Break down each concept from the quiz questions into detailed explanations
+3. Include:
+   - Key definitions and terms
+   - Important concepts and their explanations
+   - Examples and applications
+   - Practice tips and key takeaways
+4. Organize the content into clear sections:
+   - Introduction
+   - Main Concepts
+   - Detailed Explanations
+   - Examples
+   - Summary
+   - Practice Tips
+5. Make the content:
+   - Easy to understand
+   - Well-structured
+   - Educational and informative
+   - Helpful for learning and revision
+6. Use bullet points for important points
+7. Include all explanations from the quiz
+8. Add additional relevant information to help understand the concepts
+9. Make it suitable for both beginners and advanced learners
+10. Ensure it's comprehensive but concise
+
+Format the output in a clear, readable way with proper sections and bullet points.
+Do not use any markdown symbols like ** or ##. Use simple text formatting with clear section headers.
+Make it suitable for creating a PDF study guide.
+"""
+
+def sample_content(content, num_questions):
+    # Keep evenly spaced sections from all of the extracted text rather than only its start.
+    # PDFs are extracted across all their pages; Word and text files only up to
+    # MAX_EXTRACT_CHARS from their start
+    if len(content) <= MAX_INPUT_CHARS:
+        return content
+    chunks = [content[i:i + SAMPLE_CHUNK_CHARS] for i in range(0, len(content), SAMPLE_CHUNK_CHARS)]
+    # Separators count against the budget too
+    fit = (MAX_INPUT_CHARS + len(SAMPLE_SEPARATOR)) // (SAMPLE_CHUNK_CHARS + len(SAMPLE_SEPARATOR))
+    count = max(1, min(num_questions * 3, fit, len(chunks)))
+    if count == 1:
+        picked = [0]
+    else:
+        picked = sorted({round(i * (len(chunks) - 1) / (count - 1)) for i in range(count)})
+    log.debug("Sampling %s of %s sections from %s characters of text", len(picked), len(chunks), len(content))
+    return SAMPLE_SEPARATOR.join(chunks[i] for i in picked)
+
+def generate_mcqs(input_data, num_questions, difficulty="easy", is_file=False):
+    template = FILE_MCQ_PROMPT if is_file else TOPIC_MCQ_PROMPT
+    prompt = template.format(
+        num_questions=num_questions,
+        content=input_data['content'],
+        difficulty_prompt=DIFFICULTY_PROMPTS[difficulty]
+    )
     
-    if is_file:
-        content = input_data['content']
-        prompt = f"""
-        Generate {num_questions} multiple-choice questions from the following text content:
-        {content}
-        
-        {difficulty_prompts[difficulty]}
-        
-        Additional instructions for file-based questions:
-        1. Use ONLY the information from the provided text content
-        2. Focus on key concepts and important details from the text
-        3. Include questions about specific facts, figures, or data mentioned in the text
-        4. Create questions that test comprehension of the main ideas and supporting details
-        5. Ensure questions are directly related to the content in the file
-        6. Include at least one question about any tables, lists, or structured data if present
-        7. Cover a broad range of topics from the text
-        8. Ensure questions are well-distributed across different sections of the content
-        
-        Format exactly like this for each question:
-        ## MCQ
-        Question: [question text]
-        A) [option A]
-        B) [option B]
-        C) [option C]
-        D) [option D]
-        Correct Answer: [letter of correct option]
-        
-        Ensure each question has exactly 4 options and one correct answer.
-        """
-    else:  # topic_only scenario
-        prompt = f"""
-        Generate {num_questions} multiple-choice questions from the following topic:
-        {input_data['content']}
-        
-        {difficulty_prompts[difficulty]}
-        
-        Additional instructions for topic-based questions:
-        1. Create questions that cover the main aspects of the topic
-        2. Include both theoretical and practical questions
-        3. Ensure questions are relevant to the given topic
-        4. Create a good mix of definition, concept, and application questions
-        5. Cover fundamental concepts and advanced aspects of the topic
-        6. Include questions about key terminology and important principles
-        7. Ensure questions test both understanding and application
-        8. Create questions that help build a comprehensive understanding of the topic
-        
-        Format exactly like this for each question:
-        ## MCQ
-        Question: [question text]
-        A) [option A]
-        B) [option B]
-        C) [option C]
-        D) [option D]
-        Correct Answer: [letter of correct option]
-        
-        Ensure each question has exactly 4 options and one correct answer.
-        """
+    try:
+        # Semantic matches are disabled: the fixed template dominates the embedding, so
+        # prompts on different topics look alike and would get each other's questions
+        response = cached_generate(model, prompt, f"mcq_json:{difficulty}:{num_questions}", semantic=False,
+                                   generation_config=MCQ_RESPONSE_CONFIG)
+        items = json.loads(response)
+    except Exception as e:
+        log.error("Error generating MCQs: %s", e)
+        return []
+
+    if not isinstance(items, list):
+        log.warning("Generated MCQs were not a JSON list")
+        return []
+    # Malformed items are dropped rather than failing the whole request
+    return [question for question in map(parse_mcq, items) if question]
+
+def explanation_prompt(question, correct_answer):
+    return EXPLANATION_PROMPT.format(question=question, correct_answer=correct_answer)
+
+def generate_explanation(question):
+    prompt = explanation_prompt(question['question'], question['correct_answer'])
+    try:
+        return cached_generate(model, prompt, "reasoning")
+    except Exception as e:
+        log.error("Error generating explanation: %s", e)
+        return "Explanation not available."
+
+def generate_explanations(questions):
+    # Explanations already cached (e.g. shown via /get_reasoning) need no request
+    explanations = [
+        peek(model, explanation_prompt(q['question'], q['correct_answer']), "reasoning")
+        for q in questions
+    ]
+    missing = [i for i, explanation in enumerate(explanations) if explanation is None]
+    if not missing:
+        return explanations
+
+    items = [
+        {'id': i, 'question': questions[i]['question'], 'answer': questions[i]['correct_answer']}
+        for i in missing
+    ]
+    prompt = f"""
+    For each of the following question and answer pairs, explain why the answer is correct.
+    Provide a clear, concise explanation in 2-3 sentences for each one.
+    
+    {json.dumps(items)}
     
+    Respond with ONLY a JSON array of strings, one explanation per item, in the same order.
+    """
     try:
-        response = model.generate_content(prompt)
-        return response.text
+        # Semantic matches are disabled: a similar but different quiz would get the wrong explanations
+        response = cached_generate(model, prompt, "reasoning_batch", semantic=False,
+                                   generation_config=JSON_RESPONSE_CONFIG)
+        batch = json.loads(response)
+        if (isinstance(batch, list) and len(batch) == len(missing)
+                and all(isinstance(e, str) for e in batch)):
+            for i, explanation in zip(missing, batch):
+                explanations[i] = explanation
+                # Let /get_reasoning serve these without another request
+                q = questions[i]
+                remember(model, explanation_prompt(q['question'], q['correct_answer']), "reasoning", explanation)
+            return explanations
+        log.warning("Batched explanations did not match the questions, falling back")
     except Exception as e:
-        print(f"Error generating MCQs: {e}")
-        return None
+        log.error("Error generating batched explanations: %s", e)
+
+    # Fall back to one request per missing question, issued concurrently
+    with ThreadPoolExecutor(max_workers=EXPLANATION_WORKERS) as executor:
+        for i, explanation in zip(missing, executor.map(generate_explanation, [questions[i] for i in missing])):
+            explanations[i] = explanation
+    return explanations
 
 @app.route('/')
 def index():
@@ -180,55 +528,64 @@ def generate():
     topic = request.form.get('topic')
     difficulty = request.form.get('difficulty', 'easy')
 
-    print(f"File received: {file}")  # Debug log
-    print(f"Topic received: {topic}")  # Debug log
-    print(f"Request files: {request.files}")  # Debug log
-    print(f"Request form: {request.form}")  # Debug log
+    log.debug("File received: %s", file)
+    log.debug("Topic received: %s", topic)
+    log.debug("Request files: %s", request.files)
+    log.debug("Request form: %s", request.form)
 
     try:
         num_questions = int(request.form['num_questions'])
-        print(f"Generating {num_questions} questions")  # Debug log
+        log.debug("Generating %s questions", num_questions)
     except ValueError:
         return "Please enter a valid number of questions."
 
-    # Scenario 1: Topic input only
-    if not file and topic:
-        print("Processing topic input only")  # Debug log
+    # Scenario 1: Topic input only (no filesystem work needed)
+    if not (file and file.filename) and topic:
+        log.debug("Processing topic input only")
         input_data = {
             'content': topic,
             'is_file': False
         }
     
     # Scenario 2: File upload only
-    elif file and allowed_file(file.filename):
-        print("Processing file upload only")  # Debug log
+    elif file and file.filename and allowed_file(file.filename):
+        log.debug("Processing file upload only")
         try:
-            # Create a unique filename to prevent overwriting
-            filename = secure_filename(file.filename)
-            timestamp = str(int(time.time()))
-            unique_filename = f"{timestamp}_{filename}"
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-            print(f"Saving file to: {file_path}")  # Debug log
-            
-            # Ensure the upload folder exists
-            os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-            
-            # Save the file
-            file.save(file_path)
-            print(f"File saved successfully")  # Debug log
+            ext = file_extension(file.filename)
+            temp_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{uuid.uuid4().hex}.part")
             
-            # Extract text from the file
-            file_content = extract_text_from_file(file_path)
-            if not file_content:
-                print("Failed to extract text from file")  # Debug log
-                # Clean up the file if text extraction failed
+            # Save the file, hashing it in the same pass
+            sha256 = hashlib.sha256()
+            try:
+                with open(temp_path, 'wb') as out:
+                    while chunk := file.stream.read(1 << 20):
+                        sha256.update(chunk)
+                        out.write(chunk)
+                digest = sha256.hexdigest()
+                
+                # Name the upload after its content so identical uploads share one file
+                file_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{digest}.{ext}")
+                os.replace(temp_path, file_path)
+            except Exception:
+                # e.g. the client disconnected mid-upload; don't leave the partial file behind
                 try:
-                    os.remove(file_path)
-                except:
+                    os.remove(temp_path)
+                except OSError:
                     pass
+                raise
+            log.debug("File saved to: %s", file_path)
+
+            # Extract text from the file
+            file_content = extract_text_cached(file_path, digest)
+            if not file_content:
+                log.warning("Failed to extract text from file")
+                # The file is left in place: a concurrent identical upload may be reading it
                 return "Error: Could not extract text from the uploaded file. Please try again."
             
-            print(f"Extracted text length: {len(file_content)}")  # Debug log
+            log.debug("Extracted text length: %s", len(file_content))
+            
+            # Reduce once here so neither the prompt nor the session carries more than Gemini needs
+            file_content = sample_content(file_content, num_questions)
             
             input_data = {
                 'content': file_content,
@@ -239,50 +596,20 @@ def generate():
             session['current_file'] = file_path
             
         except Exception as e:
-            print(f"Error processing file: {str(e)}")  # Debug log
+            log.error("Error processing file: %s", e)
             return f"Error processing file: {str(e)}"
     
     else:
-        print(f"Invalid input: file={file}, topic={topic}")  # Debug log
+        log.warning("Invalid input: file=%s, topic=%s", file, topic)
         return "Please provide either a file or a topic."
 
     # Generate MCQs based on the input data
-    mcqs = generate_mcqs(input_data, num_questions, difficulty)
-    if not mcqs:
-        print("Failed to generate MCQs")  # Debug log
-        return "Failed to generate MCQs. Please try again."
-
-    print(f"Generated MCQs: {mcqs[:200]}...")  # Debug log (first 200 chars)
-
-    # Process the generated MCQs
-    questions = []
-    for mcq in mcqs.split("## MCQ"):
-        if not mcq.strip():
-            continue
-            
-        lines = [line.strip() for line in mcq.split('\n') if line.strip()]
-        if len(lines) < 6:
-            continue
-
-        question = lines[0].replace("Question:", "").strip()
-        options = [
-            lines[1][3:].strip(),  # A) option
-            lines[2][3:].strip(),  # B) option
-            lines[3][3:].strip(),  # C) option
-            lines[4][3:].strip()   # D) option
-        ]
-        correct_answer = lines[5].replace("Correct Answer:", "").strip()
-
-        questions.append({
-            'question': question,
-            'options': options,
-            'correct_answer': options[ord(correct_answer.upper()) - 65]  # Convert A,B,C,D to index
-        })
+    questions = generate_mcqs(input_data, num_questions, difficulty, is_file=input_data['is_file'])
 
-    print(f"Processed {len(questions)} questions")  # Debug log
+    log.debug("Processed %s questions", len(questions))
 
     if not questions:
-        print("No valid questions generated")  # Debug log
+        log.warning("No valid questions generated")
         return "No valid questions could be generated. Please try again."
 
     # Store the necessary data in session
@@ -315,27 +642,12 @@ def quiz():
                 if correct:
                     score += 1
 
-                # Generate explanation for the question
-                prompt = f"""
-                Explain why '{q['correct_answer']}' is the correct answer to:
-                '{q['question']}'
-                
-                Provide a clear, concise explanation in 2-3 sentences.
-                """
-                try:
-                    response = model.generate_content(prompt)
-                    explanation = response.text
-                except Exception as e:
-                    print(f"Error generating explanation: {str(e)}")  # Debug log
-                    explanation = "Explanation not available."
-
                 user_answers.append({
                     'question': q['question'],
                     'options': q['options'],
                     'correct_answer': q['correct_answer'],
                     'user_answer': user_answer,
-                    'is_correct': correct,
-                    'explanation': explanation
+                    'is_correct': correct
                 })
 
             # Store user answers in session
@@ -343,8 +655,13 @@ def quiz():
             session['score'] = score
             session['total'] = len(questions)
             
-            # Create PDF with results
-            create_pdf(user_answers, score, len(questions))
+            # Create PDF with results in the background; the scoreboard polls /results_status for it
+            schedule_results_cleanup()
+            results_filename = start_results_build(user_answers, score, len(questions))
+
+            # Start the study notes now too; the scoreboard polls /notes_status for them.
+            # Building them fetches every explanation, which also warms the cache /get_reasoning uses
+            notes_filename = start_notes_build(user_answers)
             
             # Calculate percentage
             percentage = (score / len(questions) * 100) if len(questions) > 0 else 0
@@ -355,15 +672,71 @@ def quiz():
                                  score=score,
                                  total=len(questions),
                                  percentage=percentage,
+                                 results_file=results_filename,
+                                 notes_file=notes_filename,
                                  chr=chr,
                                  enumerate=enumerate)
                                  
         except Exception as e:
-            print(f"Error processing quiz submission: {str(e)}")  # Debug log
+            log.error("Error processing quiz submission: %s", e)
             return redirect(url_for('index'))
 
     return render_template('quiz.html', questions=questions, enumerate=enumerate)
 
+def build_notes_pdf(user_answers, notes_filename):
+    explanations = generate_explanations(user_answers)
+
+    # Create a more focused prompt for study notes
+    buf = io.StringIO()
+    for q, explanation in zip(user_answers, explanations):
+        buf.write('Q: ')
+        buf.write(q['question'])
+        buf.write('\nA: ')
+        buf.write(q['correct_answer'])
+        buf.write('\nE: ')
+        buf.write(explanation)
+        buf.write('\n\n')
+    questions_text = buf.getvalue()
+    prompt = NOTES_PROMPT.format(questions_text=questions_text)
+    
+    # Semantic matches are disabled for the same reason as MCQs: the template outweighs the quiz content
+    notes_content = cached_generate(model, prompt, "notes", semantic=False)
+    
+    # Create PDF with better formatting
+    pdf = new_pdf()
+    pdf.add_page()
+    
+    # Title
+    pdf.set_font(PDF_FONT, "B", 16)
+    pdf.cell(200, 10, txt="Study Notes", ln=1, align='C')
+    pdf.ln(10)
+    
+    # Content
+    pdf.set_font(PDF_FONT, "", 12)
+    
+    # Render the whole document in one call
+    pdf.write_html(notes_to_html(notes_content))
+    
+    output_pdf(pdf, notes_filename)
+    log.debug("Notes generated successfully: %s", notes_filename)
+    return notes_filename
+
+def start_results_build(user_answers, score, total):
+    # Builds the results PDF in the background and records it as this session's results
+    results_filename = f"results_{uuid.uuid4().hex}.pdf"
+    submit_file_task(results_filename, create_pdf, user_answers, score, total, results_filename)
+    session['results_file'] = results_filename
+    session['results_started_at'] = time.time()
+    return results_filename
+
+def start_notes_build(user_answers):
+    # Builds the notes PDF in the background and records it as this session's notes
+    notes_filename = f"study_notes_{uuid.uuid4().hex}.pdf"
+    submit_file_task(notes_filename, build_notes_pdf, user_answers, notes_filename)
+    session['current_notes_file'] = notes_filename
+    session['notes_started_at'] = time.time()
+    return notes_filename
+
 @app.route('/scoreboard')
 def scoreboard():
     try:
@@ -379,105 +752,81 @@ def scoreboard():
         # Calculate percentage safely
         percentage = (score / total * 100) if total > 0 else 0
         
-        # Generate notes automatically when scoreboard is opened
-        try:
-            # Create a more focused prompt for study notes
-            prompt = f"""
-            Create comprehensive study notes based on the following quiz content:
-
-            Quiz Questions and Answers:
-            {chr(10).join([f"Q: {q['question']}{chr(10)}A: {q['correct_answer']}{chr(10)}E: {q['explanation']}{chr(10)}" for q in user_answers])}
-
-            Create detailed study notes that:
-            1. Start with a clear introduction explaining the main topic
-            2. Break down each concept from the quiz questions into detailed explanations
-            3. Include:
-               - Key definitions and terms
-               - Important concepts and their explanations
-               - Examples and applications
-               - Practice tips and key takeaways
-            4. Organize the content into clear sections:
-               - Introduction
-               - Main Concepts
-               - Detailed Explanations
-               - Examples
-               - Summary
-               - Practice Tips
-            5. Make the content:
-               - Easy to understand
-               - Well-structured
-               - Educational and informative
-               - Helpful for learning and revision
-            6. Use bullet points for important points
-            7. Include all explanations from the quiz
-            8. Add additional relevant information to help understand the concepts
-            9. Make it suitable for both beginners and advanced learners
-            10. Ensure it's comprehensive but concise
-
-            Format the output in a clear, readable way with proper sections and bullet points.
-            Do not use any markdown symbols like ** or ##. Use simple text formatting with clear section headers.
-            Make it suitable for creating a PDF study guide.
-            """
-            
-            response = model.generate_content(prompt)
-            notes_content = response.text
-            
-            # Create PDF with better formatting
-            pdf = FPDF()
-            pdf.add_page()
-            
-            # Title
-            pdf.set_font("Arial", "B", 16)
-            pdf.cell(200, 10, txt="Study Notes", ln=1, align='C')
-            pdf.ln(10)
-            
-            # Content
-            pdf.set_font("Arial", "", 12)
-            
-            # Split content into sections and format
-            sections = notes_content.split('\n\n')
-            for section in sections:
-                lines = section.split('\n')
-                for line in lines:
-                    line = line.strip()
-                    if not line:
-                        pdf.ln(5)
-                    elif line.endswith(':'):  # Heading
-                        pdf.set_font('Arial', 'B', 12)
-                        pdf.cell(0, 10, txt=line, ln=1)
-                        pdf.set_font('Arial', '', 12)
-                    elif line.startswith('•'):  # Bullet point
-                        pdf.set_x(10)
-                        pdf.multi_cell(0, 10, txt=line[1:].strip())
-                    else:
-                        pdf.multi_cell(0, 10, txt=line)
-                pdf.ln(5)
-            
-            # Save the PDF with a unique name based on timestamp
-            timestamp = str(int(time.time()))
-            notes_filename = f'study_notes_{timestamp}.pdf'
-            notes_path = os.path.join(app.config['RESULTS_FOLDER'], notes_filename)
-            pdf.output(notes_path)
-            
-            # Store the filename in session
-            session['current_notes_file'] = notes_filename
-            print(f"Notes generated successfully: {notes_filename}")  # Debug log
-            
-        except Exception as e:
-            print(f"Error generating notes: {str(e)}")  # Debug log
-            session['current_notes_file'] = None
+        # Reuse the PDFs started when the quiz was submitted; only build them again if that failed
+        results_filename, results_state = session_file_state(RESULTS_FILE_KEYS)
+        if results_state in (None, 'failed'):
+            results_filename = start_results_build(user_answers, score, total)
+        notes_filename, notes_state = session_file_state(NOTES_FILE_KEYS)
+        if notes_state in (None, 'failed'):
+            notes_filename = start_notes_build(user_answers)
         
         return render_template('scoreboard.html', 
                              user_answers=user_answers, 
                              score=score, 
                              total=total,
                              percentage=percentage,
+                             results_file=results_filename,
+                             notes_file=notes_filename,
                              chr=chr,
                              enumerate=enumerate)
     except Exception as e:
-        print(f"Error in scoreboard: {str(e)}")  # Debug log
+        log.error("Error in scoreboard: %s", e)
         return redirect(url_for('index'))
 
+@app.route('/notes_status')
+def notes_status():
+    notes_filename, notes_state = session_file_state(NOTES_FILE_KEYS)
+    if not notes_filename:
+        return jsonify({
+            'status': 'error',
+            'error': 'No notes have been requested.'
+        }), 404
+
+    return jsonify({
+        'status': 'success',
+        'ready': notes_state == 'ready',
+        'state': notes_state,
+        'filename': notes_filename
+    })
+
+@app.route('/results_status')
+def results_status():
+    results_filename, results_state = session_file_state(RESULTS_FILE_KEYS)
+    if not results_filename:
+        return jsonify({
+            'status': 'error',
+            'error': 'No results have been requested.'
+        }), 404
+
+    return jsonify({
+        'status': 'success',
+        'ready': results_state == 'ready',
+        'state': results_state,
+        'filename': results_filename
+    })
+
+@app.route('/generate_results', methods=['POST'])
+def generate_results():
+    user_answers = session.get('user_answers', [])
+    if not user_answers:
+        return jsonify({
+            'status': 'error',
+            'error': 'No quiz data available.'
+        }), 400
+
+    # Start again only if the last build failed or its file has been cleaned up;
+    # the page polls /results_status until it is ready
+    results_filename, results_state = session_file_state(RESULTS_FILE_KEYS)
+    if results_state in (None, 'failed'):
+        results_filename = start_results_build(user_answers, session.get('score', 0), session.get('total', 0))
+        results_state = 'pending'
+
+    return jsonify({
+        'status': 'success',
+        'state': results_state,
+        'filename': results_filename
+    })
+
 @app.route('/get_reasoning', methods=['POST'])
 def get_reasoning():
     try:
@@ -485,16 +834,10 @@ def get_reasoning():
         question = data.get('question')
         correct_answer = data.get('correct_answer')
         
-        prompt = f"""
-        Explain why '{correct_answer}' is the correct answer to:
-        '{question}'
-        
-        Provide a clear, concise explanation in 2-3 sentences.
-        """
-        
-        response = model.generate_content(prompt)
+        prompt = explanation_prompt(question, correct_answer)
+        reasoning = cached_generate(model, prompt, "reasoning")
         return jsonify({
-            'reasoning': response.text,
+            'reasoning': reasoning,
             'status': 'success'
         })
     except Exception as e:
@@ -514,149 +857,100 @@ def generate_notes():
                 'error': 'No quiz data available.'
             }), 400
 
-        # Generate notes content
-        # Create the questions text with proper line breaks
-        questions_text = ""
-        for q in user_answers:
-            questions_text += f"Q: {q['question']}\n"
-            questions_text += f"A: {q['correct_answer']}\n"
-            questions_text += f"E: {q['explanation']}\n\n"
-
-        prompt = f"""
-        Create comprehensive study notes based on the following quiz content:
-
-        Quiz Questions and Answers:
-        {questions_text}
-
-        Create detailed study notes that:
-        1. Start with a clear introduction explaining the main topic
-        2. Break down each concept from the quiz questions into detailed explanations
-        3. Include:
-           - Key definitions and terms
-           - Important concepts and their explanations
-           - Examples and applications
-           - Practice tips and key takeaways
-        4. Organize the content into clear sections:
-           - Introduction
-           - Main Concepts
-           - Detailed Explanations
-           - Examples
-           - Summary
-           - Practice Tips
-        5. Make the content:
-           - Easy to understand
-           - Well-structured
-           - Educational and informative
-           - Helpful for learning and revision
-        6. Use bullet points for important points
-        7. Include all explanations from the quiz
-        8. Add additional relevant information to help understand the concepts
-        9. Make it suitable for both beginners and advanced learners
-        10. Ensure it's comprehensive but concise
-
-        Format the output in a clear, readable way with proper sections and bullet points.
-        Do not use any markdown symbols like ** or ##. Use simple text formatting with clear section headers.
-        Make it suitable for creating a PDF study guide.
-        """
-        
-        response = model.generate_content(prompt)
-        notes_content = response.text
-        
-        # Create PDF with better formatting
-        pdf = FPDF()
-        pdf.add_page()
-        
-        # Title
-        pdf.set_font("Arial", "B", 16)
-        pdf.cell(200, 10, txt="Study Notes", ln=1, align='C')
-        pdf.ln(10)
-        
-        # Content
-        pdf.set_font("Arial", "", 12)
-        
-        # Split content into sections and format
-        sections = notes_content.split('\n\n')
-        for section in sections:
-            lines = section.split('\n')
-            for line in lines:
-                line = line.strip()
-                if not line:
-                    pdf.ln(5)
-                elif line.endswith(':'):  # Heading
-                    pdf.set_font('Arial', 'B', 12)
-                    pdf.cell(0, 10, txt=line, ln=1)
-                    pdf.set_font('Arial', '', 12)
-                elif line.startswith('•'):  # Bullet point
-                    pdf.set_x(10)
-                    pdf.multi_cell(0, 10, txt=line[1:].strip())
-                else:
-                    pdf.multi_cell(0, 10, txt=line)
-            pdf.ln(5)
-        
-        # Save the PDF with a unique name based on timestamp
-        timestamp = str(int(time.time()))
-        notes_filename = f'study_notes_{timestamp}.pdf'
-        notes_path = os.path.join(app.config['RESULTS_FOLDER'], notes_filename)
-        pdf.output(notes_path)
+        # Reuse the notes already being built, whichever worker started them, and only
+        # start again if that build failed; the page polls /notes_status until they are ready
+        notes_filename, notes_state = session_file_state(NOTES_FILE_KEYS)
+        if notes_state in (None, 'failed'):
+            notes_filename = start_notes_build(user_answers)
+            notes_state = 'pending'
         
         return jsonify({
             'status': 'success',
-            'notes_path': notes_filename
+            'state': notes_state,
+            'filename': notes_filename
         })
         
     except Exception as e:
-        print(f"Error generating notes: {str(e)}")  # Debug log
+        log.error("Error generating notes: %s", e)
         return jsonify({
             'status': 'error',
             'error': str(e)
         }), 500
 
-def create_pdf(user_answers, score, total):
-    pdf = FPDF()
+def notes_to_html(notes_content):
+    # Lines ending in ':' are headings, a leading '•' marks a bullet point
+    parts = []
+    for section in notes_content.split('\n\n'):
+        for line in section.split('\n'):
+            line = line.strip()
+            if not line:
+                continue
+            if line.endswith(':'):
+                parts.append(f"<p><b>{html.escape(line)}</b></p>")
+            elif line.startswith('•'):
+                parts.append(f"<p>{html.escape(line[1:].strip())}</p>")
+            else:
+                parts.append(f"<p>{html.escape(line)}</p>")
+        parts.append("<br>")
+    return ''.join(parts)
+
+def create_pdf(user_answers, score, total, filename='results.pdf'):
+    pdf = new_pdf()
     pdf.add_page()
     
-    # Use Helvetica font with Unicode support
-    pdf.set_font("Helvetica", size=12)
+    # One font for the whole document; no per-line font switches
+    pdf.set_font(PDF_FONT, size=12)
 
     # Add score
     pdf.cell(0, 10, f"Score: {score}/{total}", ln=True)
     pdf.ln(10)
 
-    # Add questions and answers
+    # Add questions and answers, one multi_cell per question
     for ans in user_answers:
-        # Question
-        pdf.multi_cell(0, 10, f"Q: {ans['question']}")
-        
-        # Options
+        lines = [f"Q: {ans['question']}"]
         for i, option in enumerate(ans['options']):
             status = ""
             if option == ans['correct_answer']:
                 status = "(Correct Answer)"
             elif option == ans['user_answer']:
                 status = "(Your Answer)"
-            pdf.multi_cell(0, 10, f"{chr(65+i)}) {option} {status}")
+            lines.append(f"{chr(65+i)}) {option} {status}")
+        pdf.multi_cell(0, 10, '\n'.join(lines))
         
         pdf.ln(10)
 
-    pdf_path = os.path.join(app.config['RESULTS_FOLDER'], 'results.pdf')
-    pdf.output(pdf_path)
-    return pdf_path
+    return output_pdf(pdf, filename)
+
+@app.route('/cache_stats')
+def get_cache_stats():
+    return jsonify(cache_stats())
 
 @app.route('/download/<filename>')
 def download_file(filename):
     try:
+        # Only plain file names inside RESULTS_FOLDER can be downloaded
+        if os.path.basename(filename) != filename or filename.startswith('.'):
+            log.warning("Rejected download path: %s", filename)
+            return "File not found", 404
         file_path = os.path.join(app.config['RESULTS_FOLDER'], filename)
-        print(f"Attempting to download file: {file_path}")  # Debug log
+        log.debug("Attempting to download file: %s", file_path)
         
         if not os.path.exists(file_path):
-            print(f"File not found at: {file_path}")  # Debug log
+            # The session is shared by all workers, so this holds wherever the file is being built
+            if any(session_file_state(keys) == (filename, 'pending') for keys in (RESULTS_FILE_KEYS, NOTES_FILE_KEYS)):
+                log.debug("File still being generated: %s", file_path)
+                return "File is still being generated. Please try again in a moment.", 202
+            log.warning("File not found at: %s", file_path)
             return "File not found", 404
             
-        print(f"File found, sending download")  # Debug log
-        return send_file(file_path, as_attachment=True)
+        log.debug("File found, sending download")
+        # conditional=True answers repeat downloads with 304 Not Modified
+        return send_from_directory(app.config['RESULTS_FOLDER'], filename, as_attachment=True, conditional=True)
     except Exception as e:
-        print(f"Error downloading file: {str(e)}")  # Debug log
+        log.error("Error downloading file: %s", e)
         return str(e), 500
 
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    # Local development only; production runs under Gunicorn (see gunicorn.conf.py).
+    # The reloader and interactive debugger are opt-in via FLASK_DEBUG=1.
+    app.run(debug=os.getenv('FLASK_DEBUG') == '1')
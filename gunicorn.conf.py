@@ -0,0 +1,19 @@
+import multiprocessing
+import os
+
+# Gemini calls spend most of their time waiting on the network, so use
+# gevent workers that yield on socket I/O instead of blocking a thread.
+# The gevent worker monkey-patches the standard library on start-up.
+# Hosting platforms pass the port and worker count through the environment
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+worker_class = "gevent"
+workers = int(os.getenv('WEB_CONCURRENCY', 2 * multiprocessing.cpu_count() + 1))
+worker_connections = 1000
+timeout = 120
+
+def post_worker_init(worker):
+    # gRPC's C core does not yield to gevent on its own, so each Gemini call
+    # would stall the whole worker. The app creates its gRPC channel lazily on
+    # the first call, which comes after this hook.
+    from grpc.experimental import gevent as grpc_gevent
+    grpc_gevent.init_gevent()
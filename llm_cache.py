@@ -0,0 +1,186 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import diskcache
+import numpy as np
+import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+
+EMBEDDING_MODEL = "models/text-embedding-004"
+
+# Cosine similarity above which a previous prompt counts as the same request
+SIMILARITY_THRESHOLD = 0.92
+
+# Semantic entries persist alongside the exact-match cache; each worker keeps
+# at most this many per namespace in memory, evicting the least recently used
+SEMANTIC_CACHE_DIR = 'cache/semantic'
+SEMANTIC_MAX_ENTRIES = 10_000
+
+# Longer prompts (e.g. ones embedding a whole uploaded document) only use the
+# exact-match lookup, since the embedding model truncates its input
+SEMANTIC_MAX_PROMPT_CHARS = 4000
+
+# Exact-match responses persist on disk, shared by all workers, for a week
+CACHE_DIR = 'cache/llm'
+CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# Hit and miss counts live in the same store so every worker adds to one total
+STATS_KEYS = {'hits': 'stats:hits', 'misses': 'stats:misses'}
+
+log = logging.getLogger(__name__)
+
+_exact = diskcache.Cache(CACHE_DIR)  # "namespace:sha256(model name, prompt)" -> response text
+_lock = threading.Lock()
+_semantic_store = diskcache.Cache(SEMANTIC_CACHE_DIR)  # exact-match key -> (unit embedding, response text)
+_semantic = {}  # namespace -> OrderedDict of key -> (unit embedding, response text), oldest first
+_matrices = {}  # namespace -> (stacked embeddings, keys), rebuilt after the entries change
+
+def _prompt_key(model, prompt, namespace):
+    digest = hashlib.sha256(f"{model.model_name}\0{prompt}".encode('utf-8')).hexdigest()
+    return f"{namespace}:{digest}"
+
+def _count(outcome):
+    _exact.incr(STATS_KEYS[outcome])
+
+def cache_stats():
+    stats = {outcome: _exact.get(key, 0) for outcome, key in STATS_KEYS.items()}
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    stats['entries'] = len(_exact) - sum(key in _exact for key in STATS_KEYS.values())
+    return stats
+
+def _embed(prompt):
+    try:
+        result = genai.embed_content(model=EMBEDDING_MODEL, content=prompt)
+    except Exception as e:
+        log.error("Error embedding prompt for cache lookup: %s", e)
+        return None
+    vector = np.asarray(result['embedding'], dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else None
+
+def _load_semantic():
+    # Every entry is written with the same TTL, so a later expiry means a newer entry
+    expiries = {}  # namespace -> [(expire time, key)]
+    for store_key in _semantic_store:
+        entry, expire_at = _semantic_store.get(store_key, expire_time=True)
+        if entry is None:  # Expired since iteration started
+            continue
+        namespace = store_key.rsplit(':', 1)[0]
+        expiries.setdefault(namespace, []).append((expire_at, store_key))
+
+    # Keep the newest SEMANTIC_MAX_ENTRIES per namespace, oldest first, and drop the rest from disk
+    for namespace, keyed in expiries.items():
+        keyed.sort()
+        for _, store_key in keyed[:-SEMANTIC_MAX_ENTRIES]:
+            _semantic_store.delete(store_key)
+        entries = _semantic.setdefault(namespace, OrderedDict())
+        for _, store_key in keyed[-SEMANTIC_MAX_ENTRIES:]:
+            entry = _semantic_store.get(store_key)
+            if entry is not None:
+                entries[store_key] = entry
+
+def _semantic_lookup(namespace, vector):
+    # Returns (response text, expiry time of the matched entry) or None
+    with _lock:
+        entries = _semantic.get(namespace)
+        if not entries:
+            return None
+        if namespace not in _matrices:
+            keys = list(entries)
+            _matrices[namespace] = (np.vstack([entries[key][0] for key in keys]), keys)
+        matrix, keys = _matrices[namespace]
+        similarities = matrix @ vector
+        best = int(np.argmax(similarities))
+        if similarities[best] < SIMILARITY_THRESHOLD:
+            return None
+        key = keys[best]
+        entries.move_to_end(key)
+
+    # In-memory entries don't expire by themselves; the persisted copy is the authority
+    entry, expire_at = _semantic_store.get(key, expire_time=True)
+    if entry is None:
+        with _lock:
+            entries = _semantic.get(namespace)
+            if entries is not None and entries.pop(key, None) is not None:
+                _matrices.pop(namespace, None)
+        return None
+    return entry[1], expire_at
+
+def _semantic_insert(namespace, key, vector, text):
+    # key is the exact-match key, so each prompt is indexed once
+    with _lock:
+        entries = _semantic.setdefault(namespace, OrderedDict())
+        entries[key] = (vector, text)
+        entries.move_to_end(key)
+        evicted = []
+        while len(entries) > SEMANTIC_MAX_ENTRIES:
+            evicted.append(entries.popitem(last=False)[0])
+        _matrices.pop(namespace, None)
+    _semantic_store.set(key, (vector, text), expire=CACHE_TTL_SECONDS)
+    for old_key in evicted:
+        _semantic_store.delete(old_key)
+
+_load_semantic()
+
+def _lookup(model, prompt, namespace, semantic):
+    # Returns (cached text or None, exact-match key, prompt embedding or None)
+    key = _prompt_key(model, prompt, namespace)
+    text = _exact.get(key)
+    if text is not None:
+        _count('hits')
+        return text, key, None
+
+    vector = None
+    if semantic and len(prompt) <= SEMANTIC_MAX_PROMPT_CHARS:
+        vector = _embed(prompt)
+        if vector is not None:
+            match = _semantic_lookup(namespace, vector)
+            if match is not None:
+                # The copy expires with the entry it came from, so hits can't keep it alive
+                text, expire_at = match
+                _exact.set(key, text, expire=max(1, expire_at - time.time()))
+    _count('hits' if text is not None else 'misses')
+    return text, key, vector
+
+def _store(namespace, key, vector, text):
+    _exact.set(key, text, expire=CACHE_TTL_SECONDS)
+    if vector is not None:
+        _semantic_insert(namespace, key, vector, text)
+
+# Gemini rate limits (HTTP 429) are transient, so back off and retry a few times
+@retry(
+    wait=wait_exponential(min=1, max=10),
+    stop=stop_after_attempt(3),
+    retry=retry_if_exception_type(google_exceptions.ResourceExhausted),
+    reraise=True
+)
+def _generate(model, prompt, generation_config):
+    return model.generate_content(prompt, generation_config=generation_config).text
+
+def cached_generate(model, prompt, namespace, semantic=True, generation_config=None):
+    """Return model.generate_content(prompt).text, reusing earlier responses.
+
+    Lookups first try an exact match on the prompt hash, then (for short
+    prompts, unless semantic is False) the most similar previous prompt in
+    the same namespace.
+    """
+    text, key, vector = _lookup(model, prompt, namespace, semantic)
+    if text is not None:
+        return text
+
+    text = _generate(model, prompt, generation_config)
+    _store(namespace, key, vector, text)
+    return text
+
+def peek(model, prompt, namespace):
+    """Return the exact-match cached response for prompt, or None, without calling the model."""
+    return _exact.get(_prompt_key(model, prompt, namespace))
+
+def remember(model, prompt, namespace, text):
+    """Store a response obtained some other way as the exact-match answer to prompt."""
+    _exact.set(_prompt_key(model, prompt, namespace), text, expire=CACHE_TTL_SECONDS)